@@ -5,17 +5,40 @@ HubSpot Portal property syncer.
 # Copyright 2017-2021 (c) Mayple. All rights reserved.
 # Copying and/or distribution of this file is prohibited.
 
+import collections
+import concurrent.futures
 import dataclasses
+import functools
+import logging
+import operator
+import socket
+import threading
+from typing import Counter
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import Tuple
+from typing import TypeVar
 
+import certifi
 import requests
+import urllib3
 from hubspot import HubSpot
+from hubspot.crm.properties import ApiClient
+from hubspot.crm.properties import ApiException
+from hubspot.crm.properties import BatchApi
+from hubspot.crm.properties import CoreApi
+from hubspot.crm.properties import GroupsApi
 from hubspot.crm.properties import ModelProperty
 from hubspot.crm.properties import PropertyGroup
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util import Retry
 
 
+log = logging.getLogger(__name__)
+
 # For more info about the HubSpot API etc: https://developers.hubspot.com/docs/api/crm/properties
 # And about the Python SDK: https://github.com/HubSpot/hubspot-api-python
 
@@ -24,29 +47,41 @@ from hubspot.crm.properties import PropertyGroup
 # Public Members
 # =======================================================================================================================
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Portal:
     portalId: int
     name: str
     apiKey: str
     apiClient: Optional[HubSpot] = None
+    groupsApi: Optional[GroupsApi] = None
+    coreApi: Optional[CoreApi] = None
+    batchApi: Optional[BatchApi] = None
+    verified: bool = False
+
+
+@dataclasses.dataclass(slots=True)
+class FetchCache:
+    # Fetched property groups and properties by name, by (portal ID, object type). Meant for one sequence of syncs, e.g.
+    # a chain of portal pairs, and not to be shared by concurrent syncs.
+    propertyGroups: Dict[Tuple[int, str], Dict[str, PropertyGroup]] = dataclasses.field(default_factory=dict)
+    properties: Dict[Tuple[int, str], Dict[str, ModelProperty]] = dataclasses.field(default_factory=dict)
 
 
 class ResultMessages:
 
+    __slots__ = ('_messages', '_prefix')
+
     def __init__(self, objectType: str, sourcePortal: Portal, targetPortal: Portal):
         self._messages = []
 
-        self._objectType = objectType
-        self._sourcePortal = sourcePortal
-        self._targetPortal = targetPortal
+        self._prefix = f'{sourcePortal.name}->{targetPortal.name} ({objectType}): '
 
     def addMessage(self, message: str) -> None:
-        formattedMessage = f'{self._sourcePortal.name}->{self._targetPortal.name} ({self._objectType}): {message}'
-        self._messages.append(formattedMessage)
+        # Formatted only when read
+        self._messages.append(message)
 
     def getMessages(self) -> List[str]:
-        return self._messages
+        return [self._prefix + message for message in self._messages]
 
 
 def preparePortal(portal: Portal) -> None:
@@ -54,22 +89,45 @@ def preparePortal(portal: Portal) -> None:
         raise ValueError(
             f'Missing API key for portal {portal.name}',
         )
-    response = requests.get(
-        url=f'https://api.hubapi.com/integrations/v1/me?hapikey={portal.apiKey}',
-    )
-    readPortalId = response.json()['portalId']
-    assert readPortalId == portal.portalId
+    portal.apiClient = _clientFor(portal.apiKey)
+    propertiesApiClient = _propertiesApiClientFor(portal.apiKey)
+    portal.groupsApi = GroupsApi(api_client=propertiesApiClient)
+    portal.coreApi = CoreApi(api_client=propertiesApiClient)
+    portal.batchApi = BatchApi(api_client=propertiesApiClient)
+
+
+def verifyPortals(portals: List[Portal]) -> None:
+    # Make sure the API key of each portal belongs to it, so we never write into the wrong portal. Each portal is checked
+    # once, the first time; syncProperties calls this for its portals, call it up front to fail before any sync starts.
+    with _verifyPortalsLock:
+        portalsToVerify = [portal for portal in portals if not portal.verified]
+        if not portalsToVerify:
+            return
 
-    apiClient = HubSpot(api_key=portal.apiKey)
-    portal.apiClient = apiClient
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(portalsToVerify)) as executor:
+            list(executor.map(_verifyPortalId, portalsToVerify))
+
+        for portal in portalsToVerify:
+            portal.verified = True
 
 
 def syncProperties(
     objectType: str,
     sourcePortal: Portal,
     targetPortal: Portal,
+    fetchCache: Optional[FetchCache] = None,
 ) -> ResultMessages:
-    print(f"Syncing {objectType} properties and groups from source={sourcePortal.name} to target={targetPortal.name}")
+    if fetchCache is None:
+        fetchCache = FetchCache()
+
+    verifyPortals([sourcePortal, targetPortal])
+
+    log.info(
+        "Syncing %s properties and groups from source=%s to target=%s",
+        objectType,
+        sourcePortal.name,
+        targetPortal.name,
+    )
 
     resultMessages = ResultMessages(
         objectType=objectType,
@@ -77,127 +135,133 @@ def syncProperties(
         targetPortal=targetPortal,
     )
 
-    sourceContactPropertyGroups = sourcePortal.apiClient.crm.properties.groups_api.get_all(object_type=objectType)
-    sourceContactPropertyGroupsByName: Dict[str, PropertyGroup] = {
-        currentProperty.name: currentProperty
-        for currentProperty in sourceContactPropertyGroups.results
-    }
+    # These calls are independent, so overlap their round-trips.
+    # NOTE: the properties and groups get_all endpoints are not paged - each returns the full list in a single response,
+    # so there are no page fetches to prefetch or overlap beyond this.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        sourceContactPropertyGroupsFuture = executor.submit(
+            _fetchPropertyGroups,
+            fetchCache=fetchCache,
+            portal=sourcePortal,
+            objectType=objectType,
+        )
+        sourceContactPropertiesFuture = executor.submit(
+            _fetchProperties,
+            fetchCache=fetchCache,
+            portal=sourcePortal,
+            objectType=objectType,
+        )
+        targetContactPropertyGroupsFuture = executor.submit(
+            _fetchPropertyGroups,
+            fetchCache=fetchCache,
+            portal=targetPortal,
+            objectType=objectType,
+        )
+        targetContactPropertiesFuture = executor.submit(
+            _fetchProperties,
+            fetchCache=fetchCache,
+            portal=targetPortal,
+            objectType=objectType,
+        )
 
-    sourceContactProperties = sourcePortal.apiClient.crm.properties.core_api.get_all(object_type=objectType)
-    sourcePropertiesByName: Dict[str, ModelProperty] = {
-        currentProperty.name: currentProperty
-        for currentProperty in sourceContactProperties.results
-    }
+    sourceContactPropertyGroupsByName: Dict[str, PropertyGroup] = sourceContactPropertyGroupsFuture.result()
+    sourcePropertiesByName: Dict[str, ModelProperty] = sourceContactPropertiesFuture.result()
+    targetContactPropertyGroupsByName: Dict[str, PropertyGroup] = targetContactPropertyGroupsFuture.result()
+    targetPropertiesByName: Dict[str, ModelProperty] = targetContactPropertiesFuture.result()
+
+    # What we care about, without the HubSpot-owned ones
+    sourceGroupsToSync = _withoutHubSpotOwned(sourceContactPropertyGroupsByName)
+    targetGroupsToSync = _withoutHubSpotOwned(targetContactPropertyGroupsByName)
+    sourcePropertiesToSync = _withoutHubSpotOwned(sourcePropertiesByName)
+    targetPropertiesToSync = _withoutHubSpotOwned(targetPropertiesByName)
+
+    # Name sets are built once, and reused for all the differences and intersections below
+    sourceGroupNames = set(sourceGroupsToSync)
+    targetGroupNames = set(targetGroupsToSync)
+    sourcePropertyNames = set(sourcePropertiesToSync)
+    targetPropertyNames = set(targetPropertiesToSync)
+
+    skipCounts: Counter[str] = collections.Counter()
+    skipCounts['HubSpot-owned property groups in source'] = (
+        len(sourceContactPropertyGroupsByName) - len(sourceGroupsToSync)
+    )
+    skipCounts['HubSpot-owned property groups in target'] = (
+        len(targetContactPropertyGroupsByName) - len(targetGroupsToSync)
+    )
+    skipCounts['HubSpot-owned properties in source'] = len(sourcePropertiesByName) - len(sourcePropertiesToSync)
+    skipCounts['HubSpot-owned properties in target'] = len(targetPropertiesByName) - len(targetPropertiesToSync)
 
-    targetContactPropertyGroups = targetPortal.apiClient.crm.properties.groups_api.get_all(object_type=objectType)
-    targetContactPropertyGroupsByName: Dict[str, PropertyGroup] = {
-        currentProperty.name: currentProperty
-        for currentProperty in targetContactPropertyGroups.results
-    }
-    targetContactProperties = targetPortal.apiClient.crm.properties.core_api.get_all(object_type=objectType)
-    targetPropertiesByName: Dict[str, ModelProperty] = {
-        currentProperty.name: currentProperty
-        for currentProperty in targetContactProperties.results
-    }
+    missingGroupNames = sourceGroupNames - targetGroupNames
+    missingPropertyNames = sourcePropertyNames - targetPropertyNames
 
     # PropertyGroups
     # --------------
 
     # Create missing:
-    for name, propertyGroup in sourceContactPropertyGroupsByName.items():
-        # Skip HS-owned
-        if name.startswith("hs_"):
-            print(
-                f'Skipped HubSpot-owned property group {name} in source',
-            )
-            continue
-        if not name in targetContactPropertyGroupsByName:
-            createPropertyGroupBasedOnOtherPropertyGroup(
-                resultMessages=resultMessages,
-                targetPortal=targetPortal,
-                objectType=objectType,
-                otherPropertyGroup=propertyGroup,
-            )
-        else:
-            # TODO: compare and sync
-            print(
-                f"Skipped source existing property group {name}: sync it manually, not yet implemented"
-            )
+    for name in sorted(missingGroupNames):
+        createPropertyGroupBasedOnOtherPropertyGroup(
+            resultMessages=resultMessages,
+            targetPortal=targetPortal,
+            objectType=objectType,
+            otherPropertyGroup=sourceGroupsToSync[name],
+        )
 
-    print("-------------")
+    for name in sorted(sourceGroupNames & targetGroupNames):
+        # TODO: compare and sync
+        log.debug("Skipped existing property group %s: sync it manually, not yet implemented", name)
+        skipCounts['existing property groups'] += 1
 
     # Report extra
 
-    for name, propertyGroup in targetContactPropertyGroupsByName.items():
-        # Skip HS-owned
-        if name.startswith("hs_"):
-            print(
-                f'Skipped HubSpot-owned property group {name} in target',
-            )
-            continue
-
-        if not name in sourceContactPropertyGroupsByName:
-            resultMessages.addMessage(
-                f"property group {name} is only in target - delete it "
-                f"manually or sync other way",
-            )
-        else:
-            # TODO: compare and sync
-            print(
-                f"Skipped target existing property group {name}: sync it manually, not yet implemented"
-            )
-
-    print("-------------")
+    for name in sorted(targetGroupNames - sourceGroupNames):
+        resultMessages.addMessage(
+            f"property group {name} is only in target - delete it "
+            f"manually or sync other way",
+        )
 
     # Properties
     # ----------
 
     # Create missing
 
-    for name, currentProperty in sourcePropertiesByName.items():
-        # Skip HS-owned
-        if name.startswith("hs_"):
-            print(
-                f'Skipped HubSpot-owned property {name} in source',
-            )
-            continue
+    createPropertiesBasedOnOtherProperties(
+        resultMessages=resultMessages,
+        targetPortal=targetPortal,
+        objectType=objectType,
+        otherProperties=[
+            sourcePropertiesToSync[name]
+            for name in sorted(missingPropertyNames)
+        ],
+    )
 
-        if not name in targetPropertiesByName:
-            createPropertyBasedOnOtherProperty(
-                resultMessages=resultMessages,
-                targetPortal=targetPortal,
-                objectType=objectType,
-                otherProperty=currentProperty,
-            )
-        else:
-            # TODO: compare and sync
-            print(
-                f"Skipped source existing property {name}: sync it manually, not yet implemented"
-            )
+    if missingGroupNames or missingPropertyNames:
+        # The target changed, so it has to be fetched again when it is the source of the next pair
+        _invalidateFetched(
+            fetchCache=fetchCache,
+            portal=targetPortal,
+            objectType=objectType,
+        )
 
-    print("-------------")
+    for name in sorted(sourcePropertyNames & targetPropertyNames):
+        # TODO: compare and sync
+        log.debug("Skipped existing property %s: sync it manually, not yet implemented", name)
+        skipCounts['existing properties'] += 1
 
     # Report extra
 
-    for name, currentProperty in targetPropertiesByName.items():
-        # Skip HS-owned
-        if name.startswith("hs_"):
-            print(
-                f'Skipped HubSpot-owned property group {name} in target',
-            )
-            continue
-        if not name in sourcePropertiesByName:
-            resultMessages.addMessage(
-                f"property {name} is only in target - delete it "
-                f"manually or sync other way",
-            )
-        else:
-            # TODO: compare and sync
-            print(
-                f"Skipped target existing property {name}: sync it manually, not yet implemented"
-            )
+    for name in sorted(targetPropertyNames - sourcePropertyNames):
+        resultMessages.addMessage(
+            f"property {name} is only in target - delete it "
+            f"manually or sync other way",
+        )
 
-    print("-------------")
+    log.info(
+        "Skipped for %s from source=%s to target=%s: %s",
+        objectType,
+        sourcePortal.name,
+        targetPortal.name,
+        dict(skipCounts),
+    )
 
     return resultMessages
 
@@ -209,8 +273,13 @@ def createPropertyGroupBasedOnOtherPropertyGroup(
     otherPropertyGroup: PropertyGroup,
 ) -> None:
     try:
-        print(f"Creating new property group {otherPropertyGroup.name}")
-        targetPortal.apiClient.crm.properties.groups_api.create(
+        log.info(
+            "Creating new property group %s in target=%s (%s)",
+            otherPropertyGroup.name,
+            targetPortal.name,
+            objectType,
+        )
+        targetPortal.groupsApi.create(
             objectType,
             property_group_create={
                 'name':         otherPropertyGroup.name,
@@ -225,6 +294,93 @@ def createPropertyGroupBasedOnOtherPropertyGroup(
         )
 
 
+def createPropertiesBasedOnOtherProperties(
+    resultMessages: ResultMessages,
+    targetPortal: Portal,
+    objectType: str,
+    otherProperties: List[ModelProperty],
+) -> None:
+    propertiesToCreate: List[ModelProperty] = []
+    for otherProperty in otherProperties:
+        if otherProperty.calculated:
+            resultMessages.addMessage(
+                f'Skipped property {otherProperty.name}: it is a calculated property, create it manually.',
+            )
+            continue
+        propertiesToCreate.append(otherProperty)
+
+    for batchStart in range(0, len(propertiesToCreate), _BATCH_CREATE_MAX_INPUTS):
+        batchProperties = propertiesToCreate[batchStart:batchStart + _BATCH_CREATE_MAX_INPUTS]
+        try:
+            log.info(
+                "Creating new properties %s in target=%s (%s)",
+                ', '.join(otherProperty.name for otherProperty in batchProperties),
+                targetPortal.name,
+                objectType,
+            )
+            response = targetPortal.batchApi.create(
+                objectType,
+                batch_input_property_create={
+                    'inputs': [
+                        _propertyCreateBasedOnOtherProperty(otherProperty)
+                        for otherProperty in batchProperties
+                    ],
+                },
+            )
+        except Exception as e:
+            if not (isinstance(e, ApiException) and e.status in _BATCH_VALIDATION_ERROR_STATUSES):
+                # Rate limited, timed out or failed on the server side, after retries - the batch may even have gone
+                # through, so don't hammer HubSpot with single creates that would likely fail the same way
+                for otherProperty in batchProperties:
+                    resultMessages.addMessage(
+                        f'Failed creating new property {otherProperty.name} in batch: {e}',
+                    )
+                continue
+
+            # A single bad property fails the whole batch, so fall back to creating them one by one to find it
+            log.warning(
+                "Failed creating new properties in batch in target=%s (%s), creating them one by one: %s",
+                targetPortal.name,
+                objectType,
+                e,
+            )
+            for otherProperty in batchProperties:
+                createPropertyBasedOnOtherProperty(
+                    resultMessages=resultMessages,
+                    targetPortal=targetPortal,
+                    objectType=objectType,
+                    otherProperty=otherProperty,
+                )
+            continue
+
+        # A partially failed batch (207) carries an error per failed input, with the property name in its context
+        batchPropertyNames = {otherProperty.name for otherProperty in batchProperties}
+        failedPropertyNames = set()
+        for error in response.errors or []:
+            errorPropertyNames = {
+                contextValue
+                for contextValues in (error.context or {}).values()
+                for contextValue in contextValues
+                if contextValue in batchPropertyNames
+            }
+            if not errorPropertyNames:
+                resultMessages.addMessage(
+                    f'Failed creating new properties in batch: {error.message} (context: {error.context})',
+                )
+            for name in sorted(errorPropertyNames):
+                resultMessages.addMessage(
+                    f'Failed creating new property {name}: {error.message} (context: {error.context})',
+                )
+            failedPropertyNames |= errorPropertyNames
+
+        createdPropertyNames = {createdProperty.name for createdProperty in response.results}
+        for otherProperty in batchProperties:
+            if otherProperty.name not in createdPropertyNames and otherProperty.name not in failedPropertyNames:
+                resultMessages.addMessage(
+                    f'Failed creating new property {otherProperty.name}: missing from batch create response',
+                )
+
+
 def createPropertyBasedOnOtherProperty(
     resultMessages: ResultMessages,
     targetPortal: Portal,
@@ -238,32 +394,19 @@ def createPropertyBasedOnOtherProperty(
         return
 
     try:
-        print(f"Creating new property {otherProperty.name}")
-        targetPortal.apiClient.crm.properties.core_api.create(
+        log.info(
+            "Creating new property %s in target=%s (%s)",
+            otherProperty.name,
+            targetPortal.name,
             objectType,
-            property_create={
-                'name':                 otherProperty.name,
-                'label':                otherProperty.label,
-                'type':                 otherProperty.type,
-                'fieldType':            otherProperty.field_type,
-                'groupName':            otherProperty.group_name,
-                'description':          otherProperty.description,
-                'options':              otherProperty.options,
-                'displayOrder':         otherProperty.display_order,
-                'hasUniqueValue':       otherProperty.has_unique_value,
-                'hidden':               otherProperty.hidden,
-                'formField':            otherProperty.form_field,
-
-                'calculated':           otherProperty.calculated,
-                'externalOptions':      otherProperty.external_options,
-                'hubspotDefined':       otherProperty.hubspot_defined,
-                'referencedObjectType': otherProperty.referenced_object_type,
-                'showCurrencySymbol':   otherProperty.show_currency_symbol,
-            },
+        )
+        targetPortal.coreApi.create(
+            objectType,
+            property_create=_propertyCreateBasedOnOtherProperty(otherProperty),
         )
     except Exception as e:
         resultMessages.addMessage(
-            f'Failed creating new property  {otherProperty.name}: {e}',
+            f'Failed creating new property {otherProperty.name}: {e}',
         )
 
 
@@ -271,12 +414,194 @@ def createPropertyBasedOnOtherProperty(
 # Private Members
 # =======================================================================================================================
 
+_T = TypeVar('_T')
+
+_REQUEST_TIMEOUT_SECONDS = 30
+
+_HUBSPOT_OWNED_PREFIX = 'hs_'
+
+# HubSpot's batch endpoints accept at most 100 inputs per call
+_BATCH_CREATE_MAX_INPUTS = 100
+
+# Statuses with which HubSpot rejects a batch because of the inputs in it (e.g. an invalid or already existing property)
+_BATCH_VALIDATION_ERROR_STATUSES = (400, 409, 422)
+
+# Held while verifying, so that concurrent syncs don't check the same portal more than once
+_verifyPortalsLock = threading.Lock()
+
+
+class _Retry(Retry):
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        # Creates are not idempotent - a 5xx may come back after a create went through. A 429 means the request was not
+        # processed at all, so that one is safe to replay for creates too.
+        if method.upper() == 'POST' and status_code == 429:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+# HubSpot occasionally rate limits (429) or fails (5xx); retry those with backoff rather than failing the whole sync.
+# Once retries run out, the last response is returned rather than raising MaxRetryError, whose message has the full
+# URL - including the hapikey - in it; the caller (e.g. the SDK, with its ApiException) handles the error status.
+_RETRY = _Retry(
+    total=5,
+    backoff_factor=0.3,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=('GET',),
+    raise_on_status=False,
+)
+
+# Requests are small, so don't let Nagle delay them, and keep idle pooled connections alive
+_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = _SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+
+# Syncs run concurrently. Each of the pools below keeps at most this many connections per host, and blocks callers
+# while they are all in use.
+_MAX_CONCURRENT_REQUESTS = 8
+
+# All our traffic goes to api.hubapi.com, so keep connections alive and reuse them instead of doing a fresh TCP+TLS
+# handshake for every call. The portal id checks use this session.
+_SESSION = requests.Session()
+_SESSION.mount(
+    'https://',
+    _KeepAliveAdapter(
+        pool_connections=4,
+        pool_maxsize=_MAX_CONCURRENT_REQUESTS,
+        pool_block=True,
+        max_retries=_RETRY,
+    ),
+)
+
+# The SDK calls, for all portals, use this PoolManager. It verifies certificates against the certifi CA bundle, as the
+# SDK's own PoolManager would, and adds the retries and socket options above.
+_POOL_MANAGER = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=_MAX_CONCURRENT_REQUESTS,
+    block=True,
+    cert_reqs='CERT_REQUIRED',
+    ca_certs=certifi.where(),
+    retries=_RETRY,
+    socket_options=_SOCKET_OPTIONS,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _clientFor(apiKey: str) -> HubSpot:
+    return HubSpot(api_key=apiKey)
+
+
+@functools.lru_cache(maxsize=None)
+def _propertiesApiClientFor(apiKey: str) -> ApiClient:
+    # Every access to an SDK API property builds a new ApiClient with its own PoolManager. Build one per portal, to be
+    # shared by all its properties APIs, and swap its PoolManager for the shared SDK one. The API key is sent as a query
+    # parameter, so SDK connections are shared across portals as well.
+    apiClient = _clientFor(apiKey).crm.properties.core_api.api_client
+    apiClient.rest_client.pool_manager = _POOL_MANAGER
+    return apiClient
+
+
+def _fetchPropertyGroups(fetchCache: FetchCache, portal: Portal, objectType: str) -> Dict[str, PropertyGroup]:
+    cacheKey = (portal.portalId, objectType)
+    if cacheKey not in fetchCache.propertyGroups:
+        # Only the by-name dict is kept; the SDK response and its result list are dropped right after indexing
+        fetchCache.propertyGroups[cacheKey] = _byName(portal.groupsApi.get_all(object_type=objectType).results)
+    return fetchCache.propertyGroups[cacheKey]
+
+
+def _fetchProperties(fetchCache: FetchCache, portal: Portal, objectType: str) -> Dict[str, ModelProperty]:
+    cacheKey = (portal.portalId, objectType)
+    if cacheKey not in fetchCache.properties:
+        fetchCache.properties[cacheKey] = _byName(portal.coreApi.get_all(object_type=objectType).results)
+    return fetchCache.properties[cacheKey]
+
+
+def _invalidateFetched(fetchCache: FetchCache, portal: Portal, objectType: str) -> None:
+    cacheKey = (portal.portalId, objectType)
+    fetchCache.propertyGroups.pop(cacheKey, None)
+    fetchCache.properties.pop(cacheKey, None)
+
+
+def _byName(items: Iterable[_T]) -> Dict[str, _T]:
+    return {
+        currentItem.name: currentItem
+        for currentItem in items
+    }
+
+
+def _withoutHubSpotOwned(byName: Dict[str, _T]) -> Dict[str, _T]:
+    return {
+        name: value
+        for name, value in byName.items()
+        if not name.startswith(_HUBSPOT_OWNED_PREFIX)
+    }
+
+
+def _verifyPortalId(portal: Portal) -> None:
+    response = _SESSION.get(
+        url='https://api.hubapi.com/integrations/v1/me',
+        params={'hapikey': portal.apiKey},
+        timeout=_REQUEST_TIMEOUT_SECONDS,
+    )
+    # Not response.raise_for_status(): its message has the URL, and with it the API key
+    if not response.ok:
+        raise ValueError(
+            f'Failed verifying the API key of portal {portal.name}: HTTP {response.status_code}',
+        )
+    readPortalId = response.json()['portalId']
+    if readPortalId != portal.portalId:
+        raise ValueError(
+            f'API key of portal {portal.name} belongs to portal {readPortalId}, expected portal {portal.portalId}',
+        )
+
+
+# SDK model attribute -> property create API field
+_PROPERTY_CREATE_FIELDS = {
+    'name':                   'name',
+    'label':                  'label',
+    'type':                   'type',
+    'field_type':             'fieldType',
+    'group_name':             'groupName',
+    'description':            'description',
+    'options':                'options',
+    'display_order':          'displayOrder',
+    'has_unique_value':       'hasUniqueValue',
+    'hidden':                 'hidden',
+    'form_field':             'formField',
+
+    'calculated':             'calculated',
+    'external_options':       'externalOptions',
+    'hubspot_defined':        'hubspotDefined',
+    'referenced_object_type': 'referencedObjectType',
+    'show_currency_symbol':   'showCurrencySymbol',
+}
+
+_getPropertyCreateValues = operator.attrgetter(*_PROPERTY_CREATE_FIELDS.keys())
+
+
+def _propertyCreateBasedOnOtherProperty(otherProperty: ModelProperty) -> Dict:
+    return dict(zip(_PROPERTY_CREATE_FIELDS.values(), _getPropertyCreateValues(otherProperty)))
+
+
 # =======================================================================================================================
 # Main
 # =======================================================================================================================
 
 if __name__ == "__main__":
 
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(message)s',
+    )
+
     portal1Portal = Portal(
         portalId=111111,
         name="portal1",
@@ -311,21 +636,42 @@ if __name__ == "__main__":
         (portal3Portal, portal4Portal),
     ]
 
-    allMessages = []
-    for currentSourcePortal, currentTargetPortal, in portalPairs:
-
-        for currentObjectType in [
-            "contact",
-            "company",
-            "deal",
-            "ticket",
-        ]:
+    # Make sure we are not about to write into the wrong portal, before any sync starts
+    verifyPortals([
+        portal1Portal,
+        portal2Portal,
+        portal3Portal,
+        portal4Portal,
+    ])
+
+    def syncObjectType(objectType: str) -> List[str]:
+        # Pairs are synced in order, so that whatever is created in a target is seen when it is the source of the
+        # next pair. A portal that is the target of one pair and the source of the next is fetched once if unchanged.
+        objectTypeMessages = []
+        objectTypeFetchCache = FetchCache()
+        for currentSourcePortal, currentTargetPortal, in portalPairs:
             currentResultMessages = syncProperties(
-                objectType=currentObjectType,
+                objectType=objectType,
                 sourcePortal=currentSourcePortal,
                 targetPortal=currentTargetPortal,
+                fetchCache=objectTypeFetchCache,
             )
-            allMessages.extend(currentResultMessages.getMessages())
+            objectTypeMessages.extend(currentResultMessages.getMessages())
+        return objectTypeMessages
+
+    # Object types are independent of each other, so sync them concurrently
+    allMessages = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        for currentObjectTypeMessages in executor.map(
+            syncObjectType,
+            [
+                "contact",
+                "company",
+                "deal",
+                "ticket",
+            ],
+        ):
+            allMessages.extend(currentObjectTypeMessages)
 
     print("Requires manual attention:")
     print('\n'.join(allMessages))